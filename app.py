@@ -2,13 +2,20 @@ from __future__ import annotations
 
 from ussd_warnings import *
 
+import hmac
 import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Optional, Iterator, Union
 
-from flask import Flask, request, abort, render_template_string
+from flask import Flask, Response, request, abort
+from jinja2 import BaseLoader, Environment
 
 import logging
 import sys
@@ -63,47 +70,177 @@ PILOT_VILLAGES: List[Tuple[str, str]] = [
     ("3", "Murende"),
 ]
 
+# Lookup maps (built once; used on every USSD hit)
+_CATEGORY_MAP: Dict[str, str] = dict(PILOT_CATEGORIES)
+_TRANSPORT_SUBCAT_MAP: Dict[str, str] = dict(TRANSPORT_SUBCATS)
+_VILLAGE_MAP: Dict[str, str] = dict(PILOT_VILLAGES)
+_CATEGORY_KEYS = frozenset(k for k, _ in PILOT_CATEGORIES)
+
 # =========================
 # In-memory session state
-# (fine for pilot; resets on restart)
+# (fine for pilot; resets on restart; per process, so run a single worker)
 # =========================
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+# Bounded LRU keyed by sessionId; idle sessions expire after _SESSION_TTL.
+SESSIONS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_SESSIONS_MAX = 10000
+_SESSION_TTL = 300.0  # USSD sessions are short-lived
+_SESSIONS_LOCK = threading.Lock()
 RECENT_LIMIT = 5
 
 # =========================
 # Database
 # =========================
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# SQL text is kept byte-identical per query so each pooled connection's
+# statement cache (cached_statements) prepares it only once.
+SQL_INSERT = """
+    INSERT INTO businesses (name, category, phone, village, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+SQL_LIST_BY_CATEGORY = """
+    SELECT id, name, category, phone, village, created_at
+    FROM businesses
+    WHERE category = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+SQL_LIST_BY_CATEGORIES_TMPL = """
+    SELECT id, name, category, phone, village, created_at
+    FROM businesses
+    WHERE category IN ({placeholders})
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+# Per-connection tuning (WAL itself is persistent and set once in init_db).
+CONNECTION_PRAGMAS: List[str] = [
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=134217728;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA cache_size=-16000;",
+]
+
+
+class SQLiteConnectionPool:
+    """
+    Bounded pool of long-lived SQLite connections.
+    Connections are opened lazily (up to max_connections) and reused, so the
+    open cost is paid once and each connection's page cache stays warm.
+    """
+
+    def __init__(self, path: Path, max_connections: int = 8) -> None:
+        self.path = path
+        self.max_connections = max_connections
+        self._idle: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=max_connections)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=128,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def checkout(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_connections:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # Pool exhausted: wait for another request to return a connection.
+        return self._idle.get()
+
+    def checkin(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+
+pool = SQLiteConnectionPool(DB_PATH, max_connections=8)
+
+
+_INIT_LOCK = threading.Lock()
+_INITIALIZED = False
 
 
 def init_db() -> None:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS businesses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            category TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            village TEXT NOT NULL DEFAULT 'Bumala',
-            created_at TEXT NOT NULL
-        );
-        """
-    )
+    """
+    Create/migrate the schema once per process.
+    Uses its own short-lived connection (not the pool): under
+    `gunicorn --preload` this runs in the master, and SQLite connections
+    must not be carried across fork() into the workers.
+    """
+    global _INITIALIZED
+    with _INIT_LOCK:
+        if _INITIALIZED:
+            return
+        _init_schema()
+        _INITIALIZED = True
+
+
+def _init_schema() -> None:
+    with closing(sqlite3.connect(DB_PATH, isolation_level=None)) as conn:
+        cur = conn.cursor()
+        # WAL: readers don't block the writer (and vice versa).
+        cur.execute("PRAGMA journal_mode=WAL;")
 
-    # Ensure village column exists (older DB safety)
-    cur.execute("PRAGMA table_info(businesses);")
-    cols = [r[1] for r in cur.fetchall()]
-    if "village" not in cols:
         cur.execute(
-            "ALTER TABLE businesses ADD COLUMN village TEXT NOT NULL DEFAULT 'Bumala';"
+            """
+            CREATE TABLE IF NOT EXISTS businesses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                category TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                village TEXT NOT NULL DEFAULT 'Bumala',
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+
+        # Ensure village column exists (older DB safety).
+        # One-shot migration: user_version=1 marks it done.
+        cur.execute("PRAGMA user_version;")
+        if int(cur.fetchone()[0]) < 1:
+            cur.execute("PRAGMA table_info(businesses);")
+            cols = [r[1] for r in cur.fetchall()]
+            if "village" not in cols:
+                cur.execute(
+                    "ALTER TABLE businesses ADD COLUMN village TEXT NOT NULL DEFAULT 'Bumala';"
+                )
+            cur.execute("PRAGMA user_version = 1;")
+
+        # Latest-by-category listings: index range scan instead of a full sort
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_businesses_category_id ON businesses(category, id DESC);"
         )
-    conn.commit()
-    conn.close()
 
 
 def utc_now_iso() -> str:
@@ -111,40 +248,47 @@ def utc_now_iso() -> str:
 
 
 def get_session(session_id: str) -> Dict[str, Any]:
-    if session_id not in SESSIONS:
-        SESSIONS[session_id] = {"recent": [], "add": {}}
-    return SESSIONS[session_id]
+    now = time.monotonic()
+    with _SESSIONS_LOCK:
+        session = SESSIONS.get(session_id)
+        if session is not None:
+            session["last_seen"] = now
+            SESSIONS.move_to_end(session_id)
+            return session
+
+        # Least recently used first: drop expired sessions from the front
+        while SESSIONS:
+            oldest = next(iter(SESSIONS.values()))
+            if now - oldest["last_seen"] <= _SESSION_TTL:
+                break
+            SESSIONS.popitem(last=False)
+
+        session = {"recent": deque(maxlen=RECENT_LIMIT), "add": {}, "last_seen": now}
+        SESSIONS[session_id] = session
+        while len(SESSIONS) > _SESSIONS_MAX:
+            SESSIONS.popitem(last=False)
+        return session
 
 
 def add_recent(session: Dict[str, Any], phone: str) -> None:
     if not phone:
         return
-    recent = session.get("recent", [])
+    recent = session["recent"]
     if phone in recent:
         recent.remove(phone)
-    recent.insert(0, phone)
-    session["recent"] = recent[:RECENT_LIMIT]
+    recent.appendleft(phone)
 
 
 def category_label(choice: str) -> Optional[str]:
-    for k, v in PILOT_CATEGORIES:
-        if k == choice:
-            return v
-    return None
+    return _CATEGORY_MAP.get(choice)
 
 
 def transport_subcat_label(choice: str) -> Optional[str]:
-    for k, v in TRANSPORT_SUBCATS:
-        if k == choice:
-            return v
-    return None
+    return _TRANSPORT_SUBCAT_MAP.get(choice)
 
 
 def village_label(choice: str) -> Optional[str]:
-    for k, v in PILOT_VILLAGES:
-        if k == choice:
-            return v
-    return None
+    return _VILLAGE_MAP.get(choice)
 
 
 def normalize_phone(p: str) -> str:
@@ -179,55 +323,93 @@ def transport_query_categories(subcat: str) -> List[str]:
     return ["Transport"]
 
 
-def list_latest_by_category(category: str, limit: int = 20) -> List[sqlite3.Row]:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, name, category, phone, village, created_at
-        FROM businesses
-        WHERE category = ?
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (category, limit),
-    )
-    rows = cur.fetchall()
-    conn.close()
+# =========================
+# Listing cache (latest-N per category)
+# Small TTL-bounded LRU; cleared on every insert.
+# _LIST_CACHE_GEN is bumped on clear so a fill that raced an insert isn't stored.
+# =========================
+_LIST_CACHE: "OrderedDict[Tuple[Tuple[str, ...], int], Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+_LIST_CACHE_MAX = 32
+_LIST_CACHE_TTL = 30.0
+_LIST_CACHE_LOCK = threading.Lock()
+_LIST_CACHE_GEN = 0
+
+
+def _list_cache_get(key: Tuple[Tuple[str, ...], int]) -> Optional[List[Dict[str, Any]]]:
+    with _LIST_CACHE_LOCK:
+        hit = _LIST_CACHE.get(key)
+        if hit is None:
+            return None
+        stored_at, rows = hit
+        if time.monotonic() - stored_at > _LIST_CACHE_TTL:
+            del _LIST_CACHE[key]
+            return None
+        _LIST_CACHE.move_to_end(key)
+        return rows
+
+
+def _list_cache_generation() -> int:
+    with _LIST_CACHE_LOCK:
+        return _LIST_CACHE_GEN
+
+
+def _list_cache_put(key: Tuple[Tuple[str, ...], int], rows: List[Dict[str, Any]], gen: int) -> None:
+    with _LIST_CACHE_LOCK:
+        if gen != _LIST_CACHE_GEN:
+            return
+        _LIST_CACHE[key] = (time.monotonic(), rows)
+        _LIST_CACHE.move_to_end(key)
+        while len(_LIST_CACHE) > _LIST_CACHE_MAX:
+            _LIST_CACHE.popitem(last=False)
+
+
+def _list_cache_clear() -> None:
+    global _LIST_CACHE_GEN
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE.clear()
+        _LIST_CACHE_GEN += 1
+
+
+def list_latest_by_category(category: str, limit: int = 20) -> List[Dict[str, Any]]:
+    key = ((category,), limit)
+    cached = _list_cache_get(key)
+    if cached is not None:
+        return cached
+
+    gen = _list_cache_generation()
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_LIST_BY_CATEGORY, (category, limit))
+        rows = [dict(r) for r in cur.fetchall()]
+    _list_cache_put(key, rows, gen)
     return rows
 
 
-def list_latest_by_categories(categories: List[str], limit: int = 20) -> List[sqlite3.Row]:
-    conn = db()
-    cur = conn.cursor()
+def list_latest_by_categories(categories: List[str], limit: int = 20) -> List[Dict[str, Any]]:
+    key = (tuple(categories), limit)
+    cached = _list_cache_get(key)
+    if cached is not None:
+        return cached
+
     placeholders = ",".join(["?"] * len(categories))
-    cur.execute(
-        f"""
-        SELECT id, name, category, phone, village, created_at
-        FROM businesses
-        WHERE category IN ({placeholders})
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (*categories, limit),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    sql = SQL_LIST_BY_CATEGORIES_TMPL.format(placeholders=placeholders)
+    gen = _list_cache_generation()
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, (*categories, limit))
+        rows = [dict(r) for r in cur.fetchall()]
+    _list_cache_put(key, rows, gen)
     return rows
 
 
 def insert_business(name: str, category: str, phone: str, village: str) -> None:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO businesses (name, category, phone, village, created_at)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (name.strip(), category.strip(), phone.strip(), village.strip(), utc_now_iso()),
-    )
-    conn.commit()
-    conn.close()
+    with pool.connection() as conn:
+        conn.execute(
+            SQL_INSERT,
+            (name.strip(), category.strip(), phone.strip(), village.strip(), utc_now_iso()),
+        )
+    _list_cache_clear()
+    _invalidate_dashboard_cache()
 
 
 # =========================
@@ -268,7 +450,7 @@ def help_menu() -> str:
     )
 
 
-def format_list(title: str, rows: List[sqlite3.Row], show_recent: bool = True) -> str:
+def format_list(title: str, rows: List[Dict[str, Any]], show_recent: bool = True) -> str:
     header = f"CON {title}"
     if not rows:
         lines = [header, "No listings yet.", "0. Back"]
@@ -301,6 +483,37 @@ def transport_menu() -> str:
     return "\n".join(lines)
 
 
+# Static screens, built once at import (hot path just returns the string)
+_MAIN_MENU = main_menu()
+_HELP_MENU = help_menu()
+_TRANSPORT_MENU = transport_menu()
+_INVALID_TRANSPORT = "CON Invalid option.\n1. Riders\n2. Pickups\n3. Lorries\n0. Back"
+_ADD_VILLAGE_MENU = "\n".join(
+    ["CON Choose your village:", *[f"{k}. {v}" for k, v in PILOT_VILLAGES], "0. Back"]
+)
+_ADD_CATEGORY_MENU = "\n".join(
+    ["CON Choose category:", *[f"{k}. {v}" for k, v in PILOT_CATEGORIES], "0. Back"]
+)
+_ADD_TRANSPORT_MENU = "\n".join(
+    ["CON Transport type:", *[f"{k}. {v}" for k, v in TRANSPORT_SUBCATS], "0. Back"]
+)
+
+# Hottest screens, pre-encoded so the response skips per-request encoding
+_MAIN_MENU_BYTES = _MAIN_MENU.encode("utf-8")
+_HELP_MENU_BYTES = _HELP_MENU.encode("utf-8")
+_TRANSPORT_MENU_BYTES = _TRANSPORT_MENU.encode("utf-8")
+
+
+def _resp(body_bytes: bytes) -> Response:
+    # Same Content-Type Flask gives the str responses of this endpoint
+    return Response(
+        body_bytes,
+        status=200,
+        content_type="text/html; charset=utf-8",
+        direct_passthrough=True,
+    )
+
+
 # =========================
 # USSD endpoint
 # =========================
@@ -309,265 +522,262 @@ def ussd_root_alias():
     return ussd()
 
 
-@app.route("/ussd", methods=["POST"])
-def ussd():
-    session_id = request.form.get("sessionId", "").strip()
-    phone_number = request.form.get("phoneNumber", "").strip()
-    text = request.form.get("text", "").strip()
+# Handlers for the first menu token; each returns (body, status) or a Response.
+UssdResult = Union[Tuple[str, int], Response]
 
-    app.logger.info("AT USSD: sessionId=%s phone=%s text=%s", session_id, phone_number, text)
 
-    if not session_id:
-        abort(400, "Missing sessionId")
+def _handle_help(session: Dict[str, Any], parts: List[str], phone_number: str) -> UssdResult:
+    if len(parts) == 1:
+        return _resp(_HELP_MENU_BYTES)
+    return _resp(_MAIN_MENU_BYTES)
 
-    session = get_session(session_id)
-    parts = text.split("*") if text else []
-    # Africa's Talking pagination: they inject 98 as "MORE".
-    # Remove ALL "98" tokens so flows like 98*8*98*8 don't break the menu state.
-    # (Safe for our pilot: users never type 98 as real input)
-    parts = [p for p in parts if p.strip() != "98"]
 
+def _handle_recent(session: Dict[str, Any], parts: List[str], phone_number: str) -> UssdResult:
+    recent = session.get("recent", [])
+    lines = ["CON Recent numbers (this session):"]
+    if not recent:
+        lines += ["None yet.", "0. Back"]
+    else:
+        for i, num in enumerate(recent, start=1):
+            lines.append(f"{i}. {num}")
+        lines.append("0. Back")
+    return ussd_response("\n".join(lines)), 200
 
 
+# =========================
+# Transport submenu (WITH BACK SUPPORT)
+# =========================
+def _handle_transport(session: Dict[str, Any], parts: List[str], phone_number: str) -> UssdResult:
+    # 3 -> show submenu
+    if len(parts) == 1:
+        return _resp(_TRANSPORT_MENU_BYTES)
+    # 3*0 -> back to MAIN menu (user pressed 0 while in Transport menu)
+    if len(parts) == 2 and parts[1].strip() == "0":
+        return _resp(_MAIN_MENU_BYTES)
+
+    # 3*1*0 / 3*2*0 / 3*3*0 -> back to Transport menu
+    if len(parts) >= 3 and parts[-1].strip() == "0":
+        return _resp(_TRANSPORT_MENU_BYTES)
+
+    sub_choice = parts[1].strip()
+    sub_label = transport_subcat_label(sub_choice)
+    if not sub_label:
+        return ussd_response(_INVALID_TRANSPORT), 200
+
+    rows = list_latest_by_categories(transport_query_categories(sub_label), limit=20)
+    for r in rows[:RECENT_LIMIT]:
+        add_recent(session, r["phone"])
+    return ussd_response(format_list(f"Transport - {sub_label} (latest):", rows)), 200
+
+
+# Other categories 1-7
+def _handle_category(session: Dict[str, Any], parts: List[str], phone_number: str) -> UssdResult:
+    cat = _CATEGORY_MAP[parts[0].strip()]
+    rows = list_latest_by_category(cat, limit=20)
+    for r in rows[:RECENT_LIMIT]:
+        add_recent(session, r["phone"])
+    return ussd_response(format_list(f"{cat} (latest):", rows)), 200
 
 
-    # MAIN MENU
-    if len(parts) == 0 or parts == [""]:
-        return ussd_response(main_menu()), 200
-
-    choice = parts[0].strip()
-
-    # HELP / BACK
-    if choice == "0":
-        if len(parts) == 1:
-            return ussd_response(help_menu()), 200
-        return ussd_response(main_menu()), 200
-
-    # RECENT
-    if choice == "9":
-        recent = session.get("recent", [])
-        lines = ["CON Recent numbers (this session):"]
-        if not recent:
-            lines += ["None yet.", "0. Back"]
-        else:
-            for i, num in enumerate(recent[:RECENT_LIMIT], start=1):
-                lines.append(f"{i}. {num}")
-            lines.append("0. Back")
-        return ussd_response("\n".join(lines)), 200
-
-    # CATEGORY BROWSE
-    cat = category_label(choice)
-
-    # =========================
-    # Transport submenu (WITH BACK SUPPORT)
-    # =========================
-    if cat == "Transport":
-        # 3 -> show submenu
-        if len(parts) == 1:
-            return ussd_response(transport_menu()), 200
-        # 3*0 -> back to MAIN menu (user pressed 0 while in Transport menu)
-        if len(parts) == 2 and parts[1].strip() == "0":
-            return ussd_response(main_menu()), 200
-
-        # 3*1*0 / 3*2*0 / 3*3*0 -> back to Transport menu
-        if len(parts) >= 3 and parts[-1].strip() == "0":
-            return ussd_response(transport_menu()), 200
-
-        sub_choice = parts[1].strip()
+# =========================
+# ADD / UPDATE (Village-first)
+# =========================
+def _handle_add(session: Dict[str, Any], parts: List[str], phone_number: str) -> UssdResult:
+    add_state = session.get("add", {})
+
+    # Step A: choose village
+    if len(parts) == 1:
+        session["add"] = {}
+        return ussd_response(_ADD_VILLAGE_MENU), 200
+
+    # Step A2: store village
+    if len(parts) == 2:
+        v_choice = parts[1].strip()
+        v_label = village_label(v_choice)
+        if not v_label:
+            return ussd_response("CON Invalid village. Choose 1-3.\n0. Back"), 200
+        add_state["village"] = v_label
+        session["add"] = add_state
+        return ussd_response("CON Enter business name:\n0. Back"), 200
+
+    # Step B: store name, show categories
+    if len(parts) == 3:
+        name = parts[2].strip()
+        if not name:
+            return ussd_response("CON Please enter a business name:\n0. Back"), 200
+        add_state["name"] = name
+        session["add"] = add_state
+        return ussd_response(_ADD_CATEGORY_MENU), 200
+
+    # Step C: store category, if Transport ask subcat, else confirm
+    if len(parts) == 4:
+        cat_choice = parts[3].strip()
+        cat_label = category_label(cat_choice)
+        if not cat_label:
+            return ussd_response("CON Invalid category. Choose 1-7.\n0. Back"), 200
+
+        add_state["category_main"] = cat_label
+        session["add"] = add_state
+
+        # If Transport -> ask subcat
+        if cat_label == "Transport":
+            return ussd_response(_ADD_TRANSPORT_MENU), 200
+
+        # Non-transport -> confirm
+        v = add_state.get("village", "Bumala")
+        n = add_state.get("name", "")
+        c = cat_label
+        p = normalize_phone(phone_number)
+
+        return ussd_response(
+            "\n".join(
+                [
+                    "CON Confirm:",
+                    f"Village: {v}",
+                    f"Name: {n}",
+                    f"Category: {c}",
+                    f"Phone:  {p}",
+                    "1. Confirm",
+                    "2. Cancel",
+                    "0. Back",
+                ]
+            )
+        ), 200
+
+    # Step C2: transport subcat chosen, then confirm
+    if len(parts) == 5 and add_state.get("category_main") == "Transport":
+        sub_choice = parts[4].strip()
         sub_label = transport_subcat_label(sub_choice)
         if not sub_label:
-            return ussd_response(
-                "CON Invalid option.\n1. Riders\n2. Pickups\n3. Lorries\n0. Back"
-            ), 200
-
-        rows = list_latest_by_categories(transport_query_categories(sub_label), limit=20)
-        for r in rows[:RECENT_LIMIT]:
-            add_recent(session, r["phone"])
-        return ussd_response(format_list(f"Transport - {sub_label} (latest):", rows)), 200
-
-    # Other categories 1-7
-    if cat and choice in {c[0] for c in PILOT_CATEGORIES}:
-        rows = list_latest_by_category(cat, limit=20)
-        for r in rows[:RECENT_LIMIT]:
-            add_recent(session, r["phone"])
-        return ussd_response(format_list(f"{cat} (latest):", rows)), 200
-
-    # =========================
-    # ADD / UPDATE (Village-first)
-    # =========================
-    if choice == "8":
-        add_state = session.get("add", {})
-
-        # Step A: choose village
-        if len(parts) == 1:
-            lines = ["CON Choose your village:"]
-            for k, v in PILOT_VILLAGES:
-                lines.append(f"{k}. {v}")
-            lines.append("0. Back")
+            return ussd_response(_INVALID_TRANSPORT), 200
+
+        add_state["category_sub"] = sub_label
+        session["add"] = add_state
+
+        v = add_state.get("village", "Bumala")
+        n = add_state.get("name", "")
+        c = normalize_category_for_storage("Transport", sub_label)
+        p = normalize_phone(phone_number)
+
+        return ussd_response(
+            "\n".join(
+                [
+                    "CON Confirm:",
+                    f"Village: {v}",
+                    f"Name: {n}",
+                    f"Category: {c}",
+                    f"Phone:  {p}",
+                    "1. Confirm",
+                    "2. Cancel",
+                    "0. Back",
+                ]
+            )
+        ), 200
+
+    # Confirm / Cancel
+    if len(parts) >= 5:
+        # non-transport: action is parts[4]
+        # transport: action is parts[5] (because parts[4]=subcat)
+        if add_state.get("category_main") == "Transport":
+            if len(parts) < 6:
+                return ussd_response("CON Choose 1 to confirm or 2 to cancel.\n0. Back"), 200
+            action = parts[5].strip()
+        else:
+            action = parts[4].strip()
+
+        if action == "2":
             session["add"] = {}
-            return ussd_response("\n".join(lines)), 200
-
-        # Step A2: store village
-        if len(parts) == 2:
-            v_choice = parts[1].strip()
-            v_label = village_label(v_choice)
-            if not v_label:
-                return ussd_response("CON Invalid village. Choose 1-3.\n0. Back"), 200
-            add_state["village"] = v_label
-            session["add"] = add_state
-            return ussd_response("CON Enter business name:\n0. Back"), 200
-
-        # Step B: store name, show categories
-        if len(parts) == 3:
-            name = parts[2].strip()
-            if not name:
-                return ussd_response("CON Please enter a business name:\n0. Back"), 200
-            add_state["name"] = name
-            session["add"] = add_state
-            lines = ["CON Choose category:"]
-            for k, v in PILOT_CATEGORIES:
-                lines.append(f"{k}. {v}")
-            lines.append("0. Back")
-            return ussd_response("\n".join(lines)), 200
-
-        # Step C: store category, if Transport ask subcat, else confirm
-        if len(parts) == 4:
-            cat_choice = parts[3].strip()
-            cat_label = category_label(cat_choice)
-            if not cat_label:
-                return ussd_response("CON Invalid category. Choose 1-7.\n0. Back"), 200
-
-            add_state["category_main"] = cat_label
-            session["add"] = add_state
-
-            # If Transport -> ask subcat
-            if cat_label == "Transport":
-                lines = ["CON Transport type:"]
-                for k, v in TRANSPORT_SUBCATS:
-                    lines.append(f"{k}. {v}")
-                lines.append("0. Back")
-                return ussd_response("\n".join(lines)), 200
-
-            # Non-transport -> confirm
+            return ussd_response("END Cancelled."), 200
+
+        if action == "1":
             v = add_state.get("village", "Bumala")
-            n = add_state.get("name", "")
-            c = cat_label
+            n = (add_state.get("name") or "").strip()
+            main = (add_state.get("category_main") or "").strip()
+            sub = (add_state.get("category_sub") or "").strip() if main == "Transport" else None
             p = normalize_phone(phone_number)
 
-            return ussd_response(
-                "\n".join(
-                    [
-                        "CON Confirm:",
-                        f"Village: {v}",
-                        f"Name: {n}",
-                        f"Category: {c}",
-                        f"Phone:  {p}",
-                        "1. Confirm",
-                        "2. Cancel",
-                        "0. Back",
-                    ]
-                )
-            ), 200
+            if not (v and n and main and p):
+                session["add"] = {}
+                return ussd_response("END Missing data. Please try again."), 200
 
-        # Step C2: transport subcat chosen, then confirm
-        if len(parts) == 5 and add_state.get("category_main") == "Transport":
-            sub_choice = parts[4].strip()
-            sub_label = transport_subcat_label(sub_choice)
-            if not sub_label:
-                return ussd_response(
-                    "CON Invalid option.\n1. Riders\n2. Pickups\n3. Lorries\n0. Back"
-                ), 200
+            final_cat = normalize_category_for_storage(main, sub if main == "Transport" else None)
+            insert_business(n, final_cat, p, v)
+            session["add"] = {}
+            return ussd_response("END Saved! You are now listed. Thank you."), 200
 
-            add_state["category_sub"] = sub_label
-            session["add"] = add_state
+        return ussd_response("CON Invalid option.\n1. Confirm\n2. Cancel\n0. Back"), 200
 
-            v = add_state.get("village", "Bumala")
-            n = add_state.get("name", "")
-            c = normalize_category_for_storage("Transport", sub_label)
-            p = normalize_phone(phone_number)
+    return _resp(_MAIN_MENU_BYTES)
 
-            return ussd_response(
-                "\n".join(
-                    [
-                        "CON Confirm:",
-                        f"Village: {v}",
-                        f"Name: {n}",
-                        f"Category: {c}",
-                        f"Phone:  {p}",
-                        "1. Confirm",
-                        "2. Cancel",
-                        "0. Back",
-                    ]
-                )
-            ), 200
-
-        # Confirm / Cancel
-        if len(parts) >= 5:
-            # non-transport: action is parts[4]
-            # transport: action is parts[5] (because parts[4]=subcat)
-            if add_state.get("category_main") == "Transport":
-                if len(parts) < 6:
-                    return ussd_response("CON Choose 1 to confirm or 2 to cancel.\n0. Back"), 200
-                action = parts[5].strip()
-            else:
-                action = parts[4].strip()
 
-            if action == "2":
-                session["add"] = {}
-                return ussd_response("END Cancelled."), 200
+_DISPATCH = {
+    "0": _handle_help,
+    "9": _handle_recent,
+    "3": _handle_transport,
+    "8": _handle_add,
+    **{k: _handle_category for k in _CATEGORY_KEYS if k != "3"},
+}
 
-            if action == "1":
-                v = add_state.get("village", "Bumala")
-                n = (add_state.get("name") or "").strip()
-                main = (add_state.get("category_main") or "").strip()
-                sub = (add_state.get("category_sub") or "").strip() if main == "Transport" else None
-                p = normalize_phone(phone_number)
 
-                if not (v and n and main and p):
-                    session["add"] = {}
-                    return ussd_response("END Missing data. Please try again."), 200
+@app.route("/ussd", methods=["POST"])
+def ussd():
+    session_id = request.form.get("sessionId", "").strip()
+    phone_number = request.form.get("phoneNumber", "").strip()
+    text = request.form.get("text", "").strip()
 
-                final_cat = normalize_category_for_storage(main, sub if main == "Transport" else None)
-                insert_business(n, final_cat, p, v)
-                session["add"] = {}
-                return ussd_response("END Saved! You are now listed. Thank you."), 200
+    app.logger.info("AT USSD: sessionId=%s phone=%s text=%s", session_id, phone_number, text)
 
-            return ussd_response("CON Invalid option.\n1. Confirm\n2. Cancel\n0. Back"), 200
+    if not session_id:
+        abort(400, "Missing sessionId")
+
+    session = get_session(session_id)
+    parts = text.split("*") if text else []
+    # Africa's Talking pagination: they inject 98 as "MORE".
+    # Remove ALL "98" tokens so flows like 98*8*98*8 don't break the menu state.
+    # (Safe for our pilot: users never type 98 as real input)
+    # Fast path: most requests contain no "98" at all.
+    if "98" in text:
+        parts = [p for p in parts if p.strip() != "98"]
 
-    # Unknown input -> main menu
-    return ussd_response(main_menu()), 200
+    # MAIN MENU
+    if len(parts) == 0 or parts == [""]:
+        return _resp(_MAIN_MENU_BYTES)
+
+    handler = _DISPATCH.get(parts[0].strip())
+    if handler is None:
+        # Unknown input -> main menu
+        return _resp(_MAIN_MENU_BYTES)
+    return handler(session, parts, phone_number)
 
 
 # =========================
 # Menu page (browser view)
 # =========================
-@app.route("/menu", methods=["GET"])
-def menu_page():
-    html = """
-    <!doctype html>
-    <html>
-    <head>
-      <meta charset="utf-8"/>
-      <title>USSD Menu - Village Marketplace (PILOT)</title>
-      <style>
-        body { font-family: system-ui, -apple-system, Arial; margin: 24px; line-height: 1.5; background:#f6f7f8; }
-        .card { max-width: 980px; margin: 0 auto; background:white; border-radius: 12px; padding: 24px; box-shadow: 0 4px 14px rgba(0,0,0,.08); }
-        h1 { margin-top: 0; }
-        pre { background: #f2f2f2; padding: 16px; border-radius: 8px; overflow:auto; }
-        .small { color:#666; font-size: 13px; }
-        .row { display:flex; gap:16px; flex-wrap:wrap; }
-        .col { flex: 1 1 420px; }
-      </style>
-    </head>
-    <body>
-      <div class="card">
-        <h1>Village Marketplace (PILOT)</h1>
-        <p class="small">Visual representation of the live USSD menu (for browsers, NGOs, and demos).</p>
-
-        <div class="row">
-          <div class="col">
-            <h3>Main USSD Menu</h3>
-            <pre>
+_MENU_HTML = """
+<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8"/>
+  <title>USSD Menu - Village Marketplace (PILOT)</title>
+  <style>
+    body { font-family: system-ui, -apple-system, Arial; margin: 24px; line-height: 1.5; background:#f6f7f8; }
+    .card { max-width: 980px; margin: 0 auto; background:white; border-radius: 12px; padding: 24px; box-shadow: 0 4px 14px rgba(0,0,0,.08); }
+    h1 { margin-top: 0; }
+    pre { background: #f2f2f2; padding: 16px; border-radius: 8px; overflow:auto; }
+    .small { color:#666; font-size: 13px; }
+    .row { display:flex; gap:16px; flex-wrap:wrap; }
+    .col { flex: 1 1 420px; }
+  </style>
+</head>
+<body>
+  <div class="card">
+    <h1>Village Marketplace (PILOT)</h1>
+    <p class="small">Visual representation of the live USSD menu (for browsers, NGOs, and demos).</p>
+
+    <div class="row">
+      <div class="col">
+        <h3>Main USSD Menu</h3>
+        <pre>
 CON Village Marketplace (PILOT)
 1. Shops & Daily Needs
 2. Food & Drinks
@@ -579,39 +789,46 @@ CON Village Marketplace (PILOT)
 8. Add / Update Business
 9. Recent numbers
 0. Help
-            </pre>
-          </div>
+        </pre>
+      </div>
 
-          <div class="col">
-            <h3>Transport sub-menu</h3>
-            <pre>
+      <div class="col">
+        <h3>Transport sub-menu</h3>
+        <pre>
 CON Transport
 1. Riders
 2. Pickups
 3. Lorries
 0. Back
-            </pre>
-          </div>
-        </div>
+        </pre>
+      </div>
+    </div>
 
-        <h3>Add / Update flow (Village-first)</h3>
-        <pre>
+    <h3>Add / Update flow (Village-first)</h3>
+    <pre>
 8. Add / Update Business
 → Choose your village: Sega / Bumala / Murende
 → Enter business name
 → Choose category
 → If category = Transport → choose Riders / Pickups / Lorries
 → Confirm
-        </pre>
+    </pre>
 
-        <p class="small">
-          Kenya dial (example): <b>*789*565656#</b> • Web: <b>https://api.murende.org/menu</b>
-        </p>
-      </div>
-    </body>
-    </html>
-    """
-    return html, 200
+    <p class="small">
+      Kenya dial (example): <b>*789*565656#</b> • Web: <b>https://api.murende.org/menu</b>
+    </p>
+  </div>
+</body>
+</html>
+"""
+
+
+@app.route("/menu", methods=["GET"])
+def menu_page():
+    return _MENU_HTML, 200, {
+        "Content-Type": "text/html; charset=utf-8",
+        "Cache-Control": "public, max-age=3600",
+    }
 
 
 # =========================
@@ -724,63 +941,100 @@ DASHBOARD_HTML = """
 </html>
 """
 
+# Compiled once at import; each request only renders.
+_DASH_TMPL = Environment(loader=BaseLoader(), autoescape=True).from_string(DASHBOARD_HTML)
+
+# Rendered dashboard, reused for _DASHBOARD_TTL seconds or until the next insert.
+# "gen" is bumped on invalidation so a render that raced an insert isn't stored.
+_DASHBOARD_CACHE: Dict[str, Any] = {"ts": 0.0, "html": None, "gen": 0}
+_DASHBOARD_TTL = 15.0
+_DASHBOARD_LOCK = threading.Lock()
+
+
+def _invalidate_dashboard_cache() -> None:
+    with _DASHBOARD_LOCK:
+        _DASHBOARD_CACHE["ts"] = 0.0
+        _DASHBOARD_CACHE["html"] = None
+        _DASHBOARD_CACHE["gen"] += 1
+
 
 @app.route("/dashboard", methods=["GET"])
 def dashboard():
     token = request.args.get("token", "")
-    if token != ADMIN_TOKEN:
+    # Constant-time compare (bytes: compare_digest rejects non-ASCII str)
+    if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
         abort(403)
 
-    conn = db()
-    cur = conn.cursor()
-
-    cur.execute("SELECT COUNT(*) AS cnt FROM businesses;")
-    total = int(cur.fetchone()["cnt"])
+    with _DASHBOARD_LOCK:
+        html = _DASHBOARD_CACHE["html"]
+        if html is not None and time.monotonic() - _DASHBOARD_CACHE["ts"] < _DASHBOARD_TTL:
+            return html, 200
+        gen = _DASHBOARD_CACHE["gen"]
 
-    cur.execute("SELECT COUNT(DISTINCT village) AS cnt FROM businesses;")
-    villages = int(cur.fetchone()["cnt"])
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        # One read transaction: all queries see the same snapshot.
+        # (On error the pool rolls it back when the connection is returned.)
+        cur.execute("BEGIN DEFERRED;")
 
-    cur.execute("SELECT COUNT(DISTINCT category) AS cnt FROM businesses;")
-    categories = int(cur.fetchone()["cnt"])
-
-    cur.execute(
-        "SELECT village, COUNT(*) AS cnt FROM businesses GROUP BY village ORDER BY cnt DESC, village ASC;"
-    )
-    by_village = cur.fetchall()
+        cur.execute(
+            "SELECT COUNT(*) AS total, COUNT(DISTINCT village) AS villages, "
+            "COUNT(DISTINCT category) AS categories FROM businesses;"
+        )
+        row = cur.fetchone()
+        total = int(row["total"])
+        villages = int(row["villages"])
+        categories = int(row["categories"])
 
-    cur.execute(
-        "SELECT category, COUNT(*) AS cnt FROM businesses GROUP BY category ORDER BY cnt DESC, category ASC;"
-    )
-    by_category = cur.fetchall()
+        cur.execute(
+            "SELECT village, COUNT(*) AS cnt FROM businesses GROUP BY village ORDER BY cnt DESC, village ASC;"
+        )
+        by_village = [dict(r) for r in cur.fetchall()]
 
-    cur.execute(
-        "SELECT id,name,category,village,phone,created_at FROM businesses ORDER BY id DESC LIMIT 50;"
-    )
-    latest = cur.fetchall()
+        cur.execute(
+            "SELECT category, COUNT(*) AS cnt FROM businesses GROUP BY category ORDER BY cnt DESC, category ASC;"
+        )
+        by_category = [dict(r) for r in cur.fetchall()]
 
-    def count_cat(cat: str) -> int:
-        cur.execute("SELECT COUNT(*) AS cnt FROM businesses WHERE category = ?;", (cat,))
-        return int(cur.fetchone()["cnt"])
+        cur.execute(
+            "SELECT id,name,category,village,phone,created_at FROM businesses ORDER BY id DESC LIMIT 50;"
+        )
+        latest = [dict(r) for r in cur.fetchall()]
 
-    riders = count_cat("Transport - Riders")
-    pickups = count_cat("Transport - Pickups")
-    lorries = count_cat("Transport - Lorries")
-    legacy = count_cat("Transport")
+        cur.execute(
+            "SELECT category, COUNT(*) AS cnt FROM businesses "
+            "WHERE category IN ('Transport - Riders','Transport - Pickups','Transport - Lorries','Transport') "
+            "GROUP BY category;"
+        )
+        transport_counts = {r["category"]: int(r["cnt"]) for r in cur.fetchall()}
+        cur.execute("COMMIT;")
 
-    conn.close()
+    riders = transport_counts.get("Transport - Riders", 0)
+    pickups = transport_counts.get("Transport - Pickups", 0)
+    lorries = transport_counts.get("Transport - Lorries", 0)
+    legacy = transport_counts.get("Transport", 0)
 
     now = utc_now_iso()
-    return render_template_string(
-        DASHBOARD_HTML,
+    html = _DASH_TMPL.render(
         now=now,
         totals={"total": total, "villages": villages, "categories": categories},
         transport={"riders": riders, "pickups": pickups, "lorries": lorries, "legacy": legacy},
         by_village=by_village,
         by_category=by_category,
         latest=latest,
-    ), 200
+    )
+
+    with _DASHBOARD_LOCK:
+        if _DASHBOARD_CACHE["gen"] == gen:
+            _DASHBOARD_CACHE["html"] = html
+            _DASHBOARD_CACHE["ts"] = time.monotonic()
+    return html, 200
+
+
+# Runs on import so WSGI servers (gunicorn app:app) get the schema too.
+init_db()
 
 
 if __name__ == "__main__":
-    init_db()
+    # Dev server only; production runs under gunicorn (see README).
     app.run(host="127.0.0.1", port=5000)